@@ -18,16 +18,26 @@
 #
 
 import os
+import sys
+import atexit
 import json
 import bson
 import uuid
 import re
 import datetime
 import time
+import random
+import signal
+import logging
+import cProfile
+import contextlib
+import pstats
+import threading
 from collections import OrderedDict
 from optparse import OptionParser
 from flask import Flask, Response
-from flask import session, request, redirect, url_for, current_app, make_response, abort
+from flask import session, request, redirect, url_for, current_app, make_response, abort, g
+from flask.sessions import SecureCookieSessionInterface
 import pymongo
 
 # Pseudo-JSON compression data
@@ -53,6 +63,15 @@ CONFIG = {
     # 'any' -> any host
     'trace_access_control': 'none',
     'port': 5001,
+    # Fraction (0.0 - 1.0) of requests whose per-stage timings are
+    # logged into request_log. 0 disables request tracing.
+    'request_sample_rate': 0.0,
+    'request_log': 'nots-requests.log',
+    # Directory where cProfile snapshots are stored. Profiling is
+    # toggled on/off by sending SIGUSR1 to the server process.
+    'profile_dir': '.',
+    # Start profiling right away
+    'enable_profile': False,
 }
 
 MAX_DEFAULT_OBSEL_COUNT = 1000
@@ -62,6 +81,169 @@ db = None
 
 app = Flask(__name__)
 
+# Sampled request traces are written as JSON lines through this logger
+request_logger = logging.getLogger('nots.requests')
+request_logger.propagate = False
+
+# Profiling state, toggled by toggle_profile. While profiling is
+# enabled, each request is profiled in its own thread and its
+# statistics are merged into profile_stats. profile_session is
+# incremented each time profiling starts, so that requests
+# outliving a profiling session are not merged into the next one.
+profile_enabled = False
+profile_session = 0
+profile_stats = None
+profile_lock = threading.Lock()
+# Set by the SIGUSR1 handler, see profile_toggle_worker
+profile_toggle_requested = threading.Event()
+
+@contextlib.contextmanager
+def stage_timer(name):
+    """Accumulate the time spent in a named stage of the current request.
+
+    It is a no-op if the current request is not sampled, so that it
+    can be used on hot paths.
+    """
+    stages = getattr(g, 'stages', None)
+    if stages is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get(name, 0) + time.time() - start
+
+def start_request_trace():
+    if CONFIG['request_sample_rate'] and random.random() < CONFIG['request_sample_rate']:
+        g.stages = OrderedDict()
+        g.request_start = time.time()
+
+class TracedSessionInterface(SecureCookieSessionInterface):
+    """Session interface timing session loading and saving.
+
+    Opening the session is the first per-request hook, before any
+    before_request function: the sampling decision is made there, so
+    that the session stage is timed too.
+    """
+    def open_session(self, app, request):
+        start_request_trace()
+        with stage_timer('session'):
+            return SecureCookieSessionInterface.open_session(self, app, request)
+
+    def save_session(self, app, session, response):
+        with stage_timer('session'):
+            return SecureCookieSessionInterface.save_session(self, app, session, response)
+
+app.session_interface = TracedSessionInterface()
+
+@app.after_request
+def store_request_trace_response(response):
+    if getattr(g, 'stages', None) is not None:
+        g.response_status = response.status_code
+        g.obsel_count = response.headers.get('X-Obsel-Count')
+    return response
+
+@app.teardown_request
+def log_request_trace(exc):
+    # Logging is done here rather than in after_request, so that
+    # requests failing with an unhandled exception are logged too.
+    stages = getattr(g, 'stages', None)
+    if stages is not None:
+        request_logger.info(json.dumps(OrderedDict( [
+                    ('date', datetime.datetime.now().isoformat()),
+                    ('method', request.method),
+                    ('path', request.path),
+                    ('status', getattr(g, 'response_status', 500)),
+                    ('obselCount', getattr(g, 'obsel_count', None)),
+                    ('error', None if exc is None else repr(exc)),
+                    # Durations are in ms
+                    ('duration', round(1000 * (time.time() - g.request_start), 3)),
+                    ('stages', OrderedDict( (name, round(1000 * d, 3))
+                                            for (name, d) in stages.iteritems() ))
+                    ])))
+
+@app.before_request
+def start_request_profile():
+    if profile_enabled:
+        g.profile_session = profile_session
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.teardown_request
+def stop_request_profile(exc):
+    global profile_stats
+    profiler = getattr(g, 'profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        stats = pstats.Stats(profiler)
+        with profile_lock:
+            if not profile_enabled or g.profile_session != profile_session:
+                # Profiling was stopped while the request was running
+                return
+            if profile_stats is None:
+                profile_stats = stats
+            else:
+                profile_stats.add(stats)
+
+def toggle_profile():
+    """Start or stop profiling the running server.
+
+    It only toggles profile_enabled, requests are then profiled in
+    the thread serving them. When stopping, the merged cProfile
+    snapshot is saved into CONFIG['profile_dir'] and can be inspected
+    with the pstats module.
+
+    It must not be called from a signal handler, see
+    request_profile_toggle.
+    """
+    global profile_enabled, profile_session, profile_stats
+    with profile_lock:
+        started = not profile_enabled
+        if started:
+            profile_session += 1
+            profile_stats = None
+            profile_enabled = True
+        else:
+            profile_enabled = False
+            stats, profile_stats = profile_stats, None
+    if started:
+        app.logger.warning("Profiling started")
+        return
+    if stats is None:
+        app.logger.warning("Profiling stopped. No request was profiled")
+        return
+    now = datetime.datetime.now()
+    fname = os.path.join(CONFIG['profile_dir'],
+                         'nots-%d-%s.prof' % (os.getpid(), now.strftime('%Y%m%d-%H%M%S-%f')))
+    try:
+        stats.dump_stats(fname)
+    except (IOError, OSError), e:
+        app.logger.error("Profiling stopped. Cannot save snapshot to %s: %s" % (fname, e))
+    else:
+        app.logger.warning("Profiling stopped. Snapshot saved to " + fname)
+
+def request_profile_toggle(signum, frame):
+    """SIGUSR1 handler.
+
+    Signal handlers run in the main thread, which may be serving a
+    request and holding profile_lock: the toggle itself is done by
+    profile_toggle_worker.
+    """
+    profile_toggle_requested.set()
+
+def profile_toggle_worker():
+    while True:
+        profile_toggle_requested.wait()
+        profile_toggle_requested.clear()
+        toggle_profile()
+
+def dump_running_profile():
+    """Save the profile snapshot on exit if profiling is still running.
+    """
+    if profile_enabled:
+        toggle_profile()
+
 class MongoEncoder(json.JSONEncoder):
     def default(self, obj, **kwargs):
         if isinstance(obj, bson.ObjectId):
@@ -145,34 +327,41 @@ def trace():
         if not 'userinfo' in session:
             # No explicit login. Generate a session id
             session['userinfo'] = {'id': str(uuid.uuid1())}
-            db['userinfo'].save(dict(session['userinfo']))
+            with stage_timer('mongo'):
+                db['userinfo'].save(dict(session['userinfo']))
         if request.method == 'POST':
-            obsels = request.json or []
+            with stage_timer('decode'):
+                obsels = request.json or []
         else:
             data = request.values.get('post') or request.values.get('data', "")
             if data.startswith('c['):
-                # Data mangling here. Pseudo compression is involved.
-                # Swap " and ;. Note that we use unicode.translate, so we pass a dict mapping.
-                data = data[1:].translate({ord(u'"'): u';', ord(u';'):u'"'}).replace('%23', '#')
-                # Replace keys with matching values
-                obsels = [ dict((VALUE_TABLE.get(k, k), v) for k, v in o.iteritems() )
-                           for o in json.loads(data) ]
-                # Decode optional relative ends: if end is not
-                # present, then it is the same as begin. If present,
-                # it is encoded as duration.
-                for o in obsels:
-                    o['end'] = o.get('end', 0) + o['begin']
-                    if not 'id' in o:
-                        o['id'] = ""
-                    if not 'subject' in o:
-                        o['subject'] = session['userinfo'].get('default_subject', "anonymous")
+                with stage_timer('decode'):
+                    # Data mangling here. Pseudo compression is involved.
+                    # Swap " and ;. Note that we use unicode.translate, so we pass a dict mapping.
+                    data = data[1:].translate({ord(u'"'): u';', ord(u';'):u'"'}).replace('%23', '#')
+                    data = json.loads(data)
+                with stage_timer('mapping'):
+                    # Replace keys with matching values
+                    obsels = [ dict((VALUE_TABLE.get(k, k), v) for k, v in o.iteritems() )
+                               for o in data ]
+                    # Decode optional relative ends: if end is not
+                    # present, then it is the same as begin. If present,
+                    # it is encoded as duration.
+                    for o in obsels:
+                        o['end'] = o.get('end', 0) + o['begin']
+                        if not 'id' in o:
+                            o['id'] = ""
+                        if not 'subject' in o:
+                            o['subject'] = session['userinfo'].get('default_subject', "anonymous")
             elif data:
-                obsels = json.loads(data)
+                with stage_timer('decode'):
+                    obsels = json.loads(data)
             else:
                 obsels = []
-        for obsel in obsels:
-            obsel['_serverid'] = session['userinfo'].get('id', "");
-            db['trace'].save(obsel)
+        with stage_timer('mongo'):
+            for obsel in obsels:
+                obsel['_serverid'] = session['userinfo'].get('id', "");
+                db['trace'].save(obsel)
         response = make_response()
         response.headers['X-Obsel-Count'] = str(len(obsels))
         response.headers['Access-Control-Allow-Origin'] = '*'
@@ -296,6 +485,28 @@ def ts_to_ms(ts, is_ending_timestamp=False):
             ms = None
     return ms
 
+def obsel_list_document(cursor):
+    """Return the JSON serialization of the obsels from cursor.
+
+    Cursor iteration, obsel enrichment and JSON serialization are
+    timed as separate stages.
+    """
+    with stage_timer('cursor'):
+        obsels = list(cursor)
+    with stage_timer('enrich'):
+        obsels = list(iter_enriched_obsels(obsels))
+    with stage_timer('json'):
+        return json.dumps({
+                "@context": [
+                    "http://liris.cnrs.fr/silex/2011/ktbs-jsonld-context",
+                    #{ "m": "http://localhost:8001/base1/model1#" }
+                    ],
+                "@id": ".",
+                "hasObselList": "",
+                'obsels': obsels },
+                          indent=None if request.is_xhr else 2,
+                          cls=MongoEncoder)
+
 @app.route('/trace/<path:info>', methods= [ 'GET', 'HEAD' ])
 def trace_get(info):
     if CONFIG['trace_access_control'] == 'none':
@@ -359,16 +570,7 @@ def trace_get(info):
                     # the response here
                     cursor = obsels.skip(i).limit(page_size)
                     count = cursor.count()
-                    response = current_app.response_class( json.dumps({
-                                "@context": [
-                                    "http://liris.cnrs.fr/silex/2011/ktbs-jsonld-context",
-                                    #{ "m": "http://localhost:8001/base1/model1#" }
-                                    ],
-                                "@id": ".",
-                                "hasObselList": "",
-                                'obsels': list(iter_enriched_obsels(cursor)) },
-                                                                  indent=None if request.is_xhr else 2,
-                                                                  cls=MongoEncoder),
+                    response = current_app.response_class( obsel_list_document(cursor),
                                                            mimetype='application/json')
                     response.headers['Content-Range'] = "items %d-%d/%d" % (i, i + count, total)
                     response.headers['Content-Type'] = 'application/json'
@@ -386,31 +588,13 @@ def trace_get(info):
                 # No parameters were specified and the result is too large. Return a
                 # 413 Request Entity Too Large
                 abort(413)
-            response = current_app.response_class( json.dumps({
-                        "@context": [
-                            "http://liris.cnrs.fr/silex/2011/ktbs-jsonld-context",
-                            #{ "m": "http://localhost:8001/base1/model1#" }
-                            ],
-                        "@id": ".",
-                        "hasObselList": "",
-                        'obsels': list(iter_enriched_obsels(obsels)) },
-                                                          indent=None if request.is_xhr else 2,
-                                                          cls=MongoEncoder),
+            response = current_app.response_class( obsel_list_document(obsels),
                                                    mimetype='application/json')
             response.headers['Content-Range'] = "items 0-%d/%d" % (max(count - 1, 0), total)
             return response
     elif len(info) == 2:
         # subject, id: let's ignore from/to parameters
-        return current_app.response_class( json.dumps({
-                    "@context": [
-                        "http://liris.cnrs.fr/silex/2011/ktbs-jsonld-context",
-                        #{ "m": "http://localhost:8001/base1/model1#" }
-                    ],
-                    "@id": ".",
-                    "hasObselList": "",
-                    "obsels": list(iter_enriched_obsels(db['trace'].find( { '_id': bson.ObjectId(info[1]) }))) },
-                                   indent=None if request.is_xhr else 2,
-                                   cls=MongoEncoder),
+        return current_app.response_class( obsel_list_document(db['trace'].find( { '_id': bson.ObjectId(info[1]) })),
                                            mimetype='application/json')
     else:
         return "Got info: " + ",".join(info)
@@ -619,9 +803,29 @@ if __name__ == "__main__":
                       choices=("none", "localhost", "any"), default='none',
                       help="""Control trace GET access. Values: none: no trace access; localhost: localhost only; any: any host can access""")
 
+    parser.add_option("-r", "--request-sample-rate", dest="request_sample_rate", type="float", action="store",
+                      help="Fraction (0.0 - 1.0) of requests whose per-stage timings are logged into the request log. 0 disables request tracing.",
+                      default=0.0)
+
+    parser.add_option("-l", "--request-log", dest="request_log", action="store",
+                      help="File where sampled request traces are logged, as JSON lines.",
+                      default="nots-requests.log")
+
+    parser.add_option("-P", "--profile", dest="enable_profile", action="store_true",
+                      help="Start profiling right away. Profiling can also be toggled on/off on a running server by sending it SIGUSR1. Profile snapshots are saved when profiling stops or the server exits.",
+                      default=False)
+
+    parser.add_option("--profile-dir", dest="profile_dir", action="store",
+                      help="Directory where profile snapshots are saved.",
+                      default=".")
+
     (options, args) = parser.parse_args()
     if options.enable_debug:
         options.allow_external_access = False
+    if not 0.0 <= options.request_sample_rate <= 1.0:
+        parser.error("Request sample rate must be between 0.0 and 1.0")
+    if not os.path.isdir(options.profile_dir):
+        parser.error("Profile directory %s does not exist" % options.profile_dir)
     CONFIG.update(vars(options))
 
     db = connection[CONFIG['database']]
@@ -643,6 +847,25 @@ if __name__ == "__main__":
         for k, v in CONFIG.iteritems():
             print " %s: %s" % (k, str(v))
 
+        if CONFIG['request_sample_rate']:
+            handler = logging.FileHandler(CONFIG['request_log'])
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            request_logger.addHandler(handler)
+            request_logger.setLevel(logging.INFO)
+        if hasattr(signal, 'SIGUSR1'):
+            worker = threading.Thread(target=profile_toggle_worker, name='profile-toggle')
+            worker.daemon = True
+            worker.start()
+            signal.signal(signal.SIGUSR1, request_profile_toggle)
+        # Exit cleanly on SIGTERM, so that atexit hooks are run
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        atexit.register(dump_running_profile)
+        # In debug mode, the reloader parent process does not serve
+        # any request: only profile its child.
+        if CONFIG['enable_profile'] and (not CONFIG['enable_debug']
+                                         or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+            toggle_profile()
+
         if CONFIG['enable_debug']:
             app.run(debug=True, port=CONFIG['port'])
         elif CONFIG['allow_external_access']: